@@ -1,115 +1,406 @@
 import os
+import json
+import hashlib
+import sys
+import tempfile
 import requests
 import zipfile
+import zlib
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.compute as pc
+import pyarrow.feather as feather
 from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
 
 # GTFS Source URL
 GTFS_URL = "https://assets.metrolinx.com/raw/upload/Documents/Metrolinx/Open%20Data/GO-GTFS.zip"
 GTFS_FOLDER = "gtfs_data"
+GTFS_META_PATH = os.path.join(GTFS_FOLDER, ".meta.json")
+TRIP_PAIRS_CACHE_PATH = os.path.join(GTFS_FOLDER, "trip_pairs.feather")
+TRIP_PAIRS_CACHE_VERSION = 3  # Bump when the cached columns or how they are parsed change
+DOWNLOAD_CHUNK_SIZE = 8 << 20  # 8 MiB
+DOWNLOAD_SPOOL_SIZE = 64 << 20  # Zips up to 64 MiB never touch the disk
+DOWNLOAD_TIMEOUT = 30  # seconds
+
+# Reused across downloads so repeated fetches keep the connection alive
+SESSION = requests.Session()
+
+# Only these files are read by the bot; the rest of the feed is never extracted
+GTFS_FILES = ("stop_times.txt", "trips.txt", "calendar.txt", "calendar_dates.txt")
+# A feed may leave out either calendar file, as long as it has one of them
+GTFS_REQUIRED_FILES = ("stop_times.txt", "trips.txt")
+
+# Trip pairs already loaded by this process, keyed by cache key, so a long-running
+# process only re-reads them when a new feed is fetched
+_GTFS_CACHE = {}
+
+WEEKDAYS = ("monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday")
+
+# GTFS times and service days are in the agency's local time, wherever the bot runs
+TIMEZONE = ZoneInfo("America/Toronto")
 
 # Stop IDs for Aldershot and Union (these must match GTFS data)
 ALDERSHOT_STOP_ID = "ALDERSHOT"
 UNION_STOP_ID = "UNION"
+STOP_IDS = pa.array([ALDERSHOT_STOP_ID, UNION_STOP_ID])
+
+# trip_id and stop_id repeat heavily, so read them dictionary-encoded
+STOP_TIMES_COLUMN_TYPES = {
+    "trip_id": pa.dictionary(pa.int32(), pa.string()),
+    "departure_time": pa.string(),
+    "stop_id": pa.dictionary(pa.int32(), pa.string()),
+}
+
+def load_gtfs_meta():
+    """Load the headers and hash saved from the last download."""
+    try:
+        with open(GTFS_META_PATH) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def save_gtfs_meta(meta):
+    """Persist the download's headers and hash, and which feed version the cache was built from."""
+    with open(GTFS_META_PATH, "w") as f:
+        json.dump(meta, f)
+
+def extract_gtfs(zip_file):
+    """
+    Extract the GTFS files we need from the downloaded zip, returning the names extracted.
+    Files are unpacked to a scratch directory first, so a corrupt zip leaves the current data untouched.
+    """
+    zip_file.seek(0)
+    with zipfile.ZipFile(zip_file, "r") as zip_ref, tempfile.TemporaryDirectory(dir=GTFS_FOLDER) as scratch:
+        members = set(zip_ref.namelist())
+        for name in GTFS_REQUIRED_FILES:
+            if name not in members:
+                raise zipfile.BadZipFile(f"{name} is missing from the zip")
+        for name in GTFS_FILES:
+            if name in members:
+                zip_ref.extract(name, scratch)
+
+        for name in GTFS_FILES:
+            if name in members:
+                os.replace(os.path.join(scratch, name), os.path.join(GTFS_FOLDER, name))
+            elif os.path.exists(os.path.join(GTFS_FOLDER, name)):
+                # Don't leave a previous feed's calendar behind
+                os.remove(os.path.join(GTFS_FOLDER, name))
+
+    return [name for name in GTFS_FILES if name in members]
 
 def fetch_gtfs():
-    """Fetch and extract the latest GTFS data."""
+    """
+    Fetch and extract the latest GTFS data.
+    Skips the network entirely if the feed was already extracted today,
+    skips the download and extraction if the server reports it unchanged,
+    and skips the extraction if the downloaded zip is identical to the last one.
+    """
     os.makedirs(GTFS_FOLDER, exist_ok=True)
-    zip_path = os.path.join(GTFS_FOLDER, "gtfs.zip")
+    stop_times_path = os.path.join(GTFS_FOLDER, "stop_times.txt")
+
+    # The data is only usable if it was extracted for the current GTFS_FILES and nothing has gone
+    # missing since; a data directory from an older version of the bot forces a fresh extraction
+    meta = load_gtfs_meta()
+    have_data = meta.get("gtfs_files") == list(GTFS_FILES) and all(
+        os.path.exists(os.path.join(GTFS_FOLDER, name))
+        for name in set(GTFS_REQUIRED_FILES) | set(meta.get("extracted_files", []))
+    )
+
+    if have_data:
+        extracted_on = datetime.fromtimestamp(os.path.getmtime(stop_times_path), TIMEZONE).date()
+        if extracted_on == datetime.now(TIMEZONE).date():
+            print("✅ GTFS data already fetched today.")
+            return
+
+    # Only make the request conditional if there is extracted data to fall back on
+    headers = {}
+    if have_data and meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if have_data and meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
 
     print(f"🔄 Fetching GTFS data from: {GTFS_URL}")
-    response = requests.get(GTFS_URL)
-    
-    if response.status_code == 200:
-        with open(zip_path, "wb") as f:
-            f.write(response.content)
+    with tempfile.SpooledTemporaryFile(max_size=DOWNLOAD_SPOOL_SIZE) as zip_file:
+        # Reading the body stays inside the try: a dropped or truncated download fails here too
+        try:
+            with SESSION.get(GTFS_URL, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+                if response.status_code == 304:
+                    # Refresh the mtime so the same-day check above short-circuits next run
+                    os.utime(stop_times_path)
+                    print("✅ GTFS data unchanged since last download.")
+                    return
+                if response.status_code != 200:
+                    print(f"❌ Failed to download GTFS data. HTTP {response.status_code}")
+                    return
+
+                # Stream the body into the spooled file instead of buffering it in response.content,
+                # hashing it on the way so an unchanged feed can be detected without validators
+                sha256 = hashlib.sha256()
+                for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    sha256.update(chunk)
+                    zip_file.write(chunk)
+        except requests.RequestException as e:
+            print(f"❌ Failed to download GTFS data. {e}")
+            return
         print("✅ GTFS data downloaded successfully.")
-    else:
-        print(f"❌ Failed to download GTFS data. HTTP {response.status_code}")
-        return
 
-    # Extract GTFS files
-    with zipfile.ZipFile(zip_path, "r") as zip_ref:
-        zip_ref.extractall(GTFS_FOLDER)
-    print("✅ GTFS data extracted successfully.")
+        if have_data and meta.get("sha256") == sha256.hexdigest():
+            os.utime(stop_times_path)
+            print("✅ GTFS data identical to last download, skipping extraction.")
+        else:
+            try:
+                extracted_files = extract_gtfs(zip_file)
+            except (zipfile.BadZipFile, zlib.error) as e:
+                print(f"❌ Downloaded GTFS data is not a usable feed. {e}")
+                return
+            meta["gtfs_files"] = list(GTFS_FILES)
+            meta["extracted_files"] = extracted_files
+            print("✅ GTFS data extracted successfully.")
+
+    meta.update({
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "sha256": sha256.hexdigest(),
+    })
+    save_gtfs_meta(meta)
 
-def convert_gtfs_time(gtfs_time, trip_date):
+def gtfs_times_to_seconds(gtfs_times):
     """
-    Convert GTFS time (HH:MM:SS) and trip date into a proper datetime object.
-    GTFS sometimes has hours over 24, which means the trip extends past midnight.
+    Convert GTFS times (HH:MM:SS) into seconds past midnight, vectorized.
+    GTFS sometimes has hours over 24; those are kept as-is so they still sort after midnight.
+    Raises ValueError on anything else, including blank times.
     """
-    hours, minutes, seconds = map(int, gtfs_time.split(":"))
-    trip_date_obj = datetime.strptime(trip_date, "%Y-%m-%d")
+    # Check lengths on the raw strings: casting to fixed-width bytes would silently cut longer values
+    raw_times = np.asarray(gtfs_times, dtype=str)
+    lengths = np.char.str_len(raw_times)
+    wrong_length = (lengths < 7) | (lengths > 8)
+    if wrong_length.any():
+        raise ValueError(f"Invalid GTFS time: {str(raw_times[wrong_length][0])!r}")
+
+    # Non-ASCII characters become "?" and fail the digit check below
+    times = np.char.encode(raw_times, "ascii", "replace").astype("S8")
 
-    if hours >= 24:
-        hours -= 24
-        trip_date_obj += timedelta(days=1)  # Move to the next day
+    # GTFS allows single-digit hours (H:MM:SS); pad those so every value is fixed-width
+    short = lengths == 7
+    if short.any():
+        times[short] = np.char.zfill(times[short], 8)
 
-    return datetime(trip_date_obj.year, trip_date_obj.month, trip_date_obj.day, hours, minutes, seconds)
+    chars = times.view(np.uint8).reshape(-1, 8)
+    digits = chars[:, [0, 1, 3, 4, 6, 7]] - ord("0")
+    valid = (digits <= 9).all(axis=1) & (chars[:, 2] == ord(":")) & (chars[:, 5] == ord(":"))
+    if not valid.all():
+        raise ValueError(f"Invalid GTFS time: {str(raw_times[~valid][0])!r}")
 
-def get_upcoming_trips(stop_times_df, start_stop, end_stop):
+    place_values = np.array([36000, 3600, 600, 60, 10, 1], dtype=np.int32)
+    return digits.astype(np.int32) @ place_values
+
+def format_gtfs_seconds(seconds):
+    """Format seconds past midnight as HH:MM:SS on a 24-hour clock."""
+    return f"{seconds // 3600 % 24:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+def read_stop_times_csv(stop_times_path):
+    """
+    Stream stop_times.txt with PyArrow, keeping only the Aldershot and Union rows.
+    Each block is filtered as it is read, so peak memory is one block rather than the whole file.
     """
-    Find the next 3 departures **from the current time**.
+    reader = pacsv.open_csv(
+        stop_times_path,
+        read_options=pacsv.ReadOptions(block_size=8 << 20),
+        convert_options=pacsv.ConvertOptions(
+            include_columns=list(STOP_TIMES_COLUMN_TYPES),
+            column_types=STOP_TIMES_COLUMN_TYPES,
+        ),
+    )
+    batches = [
+        batch.filter(pc.is_in(batch.column("stop_id"), value_set=STOP_IDS))
+        for batch in reader
+    ]
+    return pa.Table.from_batches(batches, schema=reader.schema).to_pandas()
+
+def pair_trips(stop_times_df):
+    """
+    Pair up each trip's Aldershot and Union stops in a single pass.
+    Each trip calls at a stop at most once, so after sorting by trip and departure time
+    consecutive rows sharing a trip_id are that trip's origin and destination.
     """
-    current_time = datetime.now()
-    today_str = current_time.strftime("%Y-%m-%d")
-    tomorrow_str = (current_time + timedelta(days=1)).strftime("%Y-%m-%d")
+    # Work on int32 trip codes rather than trip_id strings
+    trip_codes, trip_ids = pd.factorize(stop_times_df["trip_id"], sort=True)
+    order = np.lexsort((stop_times_df["departure_sec"].to_numpy(), trip_codes))
+    trip_codes = trip_codes[order].astype(np.int32)
+    stop_ids = stop_times_df["stop_id"].to_numpy()[order]
+    departure_secs = stop_times_df["departure_sec"].to_numpy()[order]
+
+    origin = np.flatnonzero(
+        (trip_codes[:-1] == trip_codes[1:]) & (departure_secs[:-1] < departure_secs[1:])
+    )
+    destination = origin + 1
 
-    # Filter trips where the start and end stop both exist
-    relevant_trips = stop_times_df[stop_times_df["stop_id"].isin([start_stop, end_stop])]
+    return pd.DataFrame({
+        "trip_id": np.asarray(trip_ids)[trip_codes[origin]],
+        "origin": pd.Categorical(stop_ids[origin]),
+        "destination": pd.Categorical(stop_ids[destination]),
+        "departure_sec": departure_secs[origin],
+        "arrival_sec": departure_secs[destination],
+    })
 
-    trips_list = []
-    
-    for trip_id, group in relevant_trips.groupby("trip_id"):
-        group = group.sort_values("stop_sequence")
+def load_trip_pairs(stop_times_path):
+    """
+    Load every Aldershot/Union trip pair in the feed (see pair_trips), with each trip's service_id.
+    The pairs are a few KB, so they are cached in memory and as Feather, and reused until the feed's zip changes.
+    """
+    meta = load_gtfs_meta()
+    cache_key = f"{meta['sha256']}:{TRIP_PAIRS_CACHE_VERSION}" if meta.get("sha256") else None
+
+    if cache_key in _GTFS_CACHE:
+        return _GTFS_CACHE[cache_key]
+    if cache_key and meta.get("trip_pairs_cache") == cache_key and os.path.exists(TRIP_PAIRS_CACHE_PATH):
+        _GTFS_CACHE[cache_key] = feather.read_feather(TRIP_PAIRS_CACHE_PATH)
+        return _GTFS_CACHE[cache_key]
 
-        start_row = group[group["stop_id"] == start_stop]
-        end_row = group[group["stop_id"] == end_stop]
+    stop_times_df = read_stop_times_csv(stop_times_path)
 
-        if not start_row.empty and not end_row.empty:
-            dep_time = convert_gtfs_time(start_row["departure_time"].iloc[0], today_str)
-            arr_time = convert_gtfs_time(end_row["departure_time"].iloc[0], today_str)
+    # Strip stray padding once, on the filtered frame. GTFS leaves times blank at stops
+    # that aren't timepoints; there is no departure to pair there
+    departure_times = stop_times_df["departure_time"].fillna("").str.strip()
+    timed = departure_times != ""
+    trip_pairs = pair_trips(pd.DataFrame({
+        "trip_id": stop_times_df["trip_id"][timed],
+        "stop_id": stop_times_df["stop_id"][timed],
+        "departure_sec": gtfs_times_to_seconds(departure_times[timed]),
+    }))
 
-            if dep_time > current_time and dep_time < arr_time:
-                trips_list.append((trip_id, dep_time.date(), dep_time, arr_time))
+    # Look up service_ids only for the paired trips rather than joining the whole trips table
+    trips_path = os.path.join(GTFS_FOLDER, "trips.txt")
+    trips_df = pd.read_csv(trips_path, usecols=["trip_id", "service_id"], dtype=str)
+    trip_services = trips_df.set_index("trip_id")["service_id"]
+    trip_pairs["service_id"] = trip_pairs["trip_id"].map(trip_services).astype("category")
 
-    # Sort trips by departure time
-    trips_list.sort(key=lambda x: x[2])
+    if cache_key:
+        feather.write_feather(trip_pairs, TRIP_PAIRS_CACHE_PATH, compression="uncompressed")
+        meta["trip_pairs_cache"] = cache_key
+        save_gtfs_meta(meta)
+        _GTFS_CACHE.clear()
+        _GTFS_CACHE[cache_key] = trip_pairs
 
-    # Get the next 3 upcoming trips
-    return trips_list[:3]
+    return trip_pairs
+
+def get_active_service_ids(service_date):
+    """
+    Find the service_ids running on `service_date`.
+    Weekly patterns come from calendar.txt, then calendar_dates.txt adds or removes services for that date.
+    Returns None if the feed has neither file, meaning service days can't be checked.
+    """
+    # GTFS dates are YYYYMMDD, so they compare correctly as strings
+    date_str = service_date.strftime("%Y%m%d")
+    active = set()
+
+    calendar_path = os.path.join(GTFS_FOLDER, "calendar.txt")
+    calendar_dates_path = os.path.join(GTFS_FOLDER, "calendar_dates.txt")
+    if not os.path.exists(calendar_path) and not os.path.exists(calendar_dates_path):
+        return None
+
+    if os.path.exists(calendar_path):
+        weekday = WEEKDAYS[service_date.weekday()]
+        calendar_df = pd.read_csv(calendar_path, usecols=["service_id", weekday, "start_date", "end_date"], dtype=str)
+        running = (
+            (calendar_df["start_date"] <= date_str)
+            & (calendar_df["end_date"] >= date_str)
+            & (calendar_df[weekday] == "1")
+        )
+        active.update(calendar_df.loc[running, "service_id"])
+
+    if os.path.exists(calendar_dates_path):
+        calendar_dates_df = pd.read_csv(calendar_dates_path, dtype=str)
+        exceptions = calendar_dates_df[calendar_dates_df["date"] == date_str]
+        active.update(exceptions.loc[exceptions["exception_type"] == "1", "service_id"])
+        active.difference_update(exceptions.loc[exceptions["exception_type"] == "2", "service_id"])
+
+    return active
+
+def get_upcoming_trips(trip_pairs, service_days):
+    """
+    Find the next 3 departures in each direction across the given service days.
+    `service_days` holds (service_date, now_sec, service_ids) tuples, with `now_sec` the current time
+    in seconds past that service day's midnight. A service_ids of None considers every trip.
+    Returns a dict keyed by (origin, destination) stop IDs of
+    (trip_id, service_date, departure_sec, arrival_sec) tuples.
+    """
+    candidates = []
+    for service_date, now_sec, service_ids in service_days:
+        mask = trip_pairs["departure_sec"] > now_sec
+        if service_ids is not None:
+            mask &= trip_pairs["service_id"].isin(service_ids)
+        # departs_in puts every service day's trips on the same clock
+        candidates.append(trip_pairs[mask].assign(
+            service_date=service_date,
+            departs_in=trip_pairs["departure_sec"][mask] - now_sec,
+        ))
+    future_trips = pd.concat(candidates, ignore_index=True)
+
+    upcoming = {}
+    for direction, trips in future_trips.groupby(["origin", "destination"], observed=True):
+        # Get the next 3 upcoming trips without sorting every candidate
+        next_trips = trips.nsmallest(3, "departs_in")
+        upcoming[direction] = list(zip(
+            next_trips["trip_id"].tolist(),
+            next_trips["service_date"].tolist(),
+            next_trips["departure_sec"].tolist(),
+            next_trips["arrival_sec"].tolist(),
+        ))
+    return upcoming
+
+def format_departures(title, departure_label, arrival_label, trips):
+    """Build the printed table of upcoming departures for one direction."""
+    lines = [
+        f"\n🚆 Next 3 Departures: {title}",
+        f"{'Trip ID':<15} {'Date':<12} {departure_label:<12} {arrival_label:<12}",
+    ]
+    lines.extend(
+        f"{trip_id:<15} {(service_date + timedelta(days=dep_sec // 86400)).isoformat():<12} "
+        f"{format_gtfs_seconds(dep_sec):<12} {format_gtfs_seconds(arr_sec):<12}"
+        for trip_id, service_date, dep_sec, arr_sec in trips
+    )
+    return "\n".join(lines)
 
 def parse_gtfs():
     """Extract upcoming GO Train departures between Aldershot and Union."""
     stop_times_path = os.path.join(GTFS_FOLDER, "stop_times.txt")
 
     try:
-        stop_times_df = pd.read_csv(stop_times_path, usecols=["trip_id", "departure_time", "stop_id", "stop_sequence"])
-    except FileNotFoundError:
-        print("❌ stop_times.txt not found.")
+        trip_pairs = load_trip_pairs(stop_times_path)
+    except FileNotFoundError as e:
+        # PyArrow's error for stop_times.txt doesn't set filename; pandas' one for trips.txt does
+        print(f"❌ {os.path.basename(e.filename or stop_times_path)} not found.")
         return
-    
-    # Read trips file to filter only valid train trips
-    trips_path = os.path.join(GTFS_FOLDER, "trips.txt")
-    trips_df = pd.read_csv(trips_path, usecols=["trip_id", "route_id"])
 
-    # Merge stop_times with trips to get route_id
-    stop_times_df = stop_times_df.merge(trips_df, on="trip_id")
+    current_time = datetime.now(TIMEZONE)
+    today = current_time.date()
+    yesterday = today - timedelta(days=1)
+    now_sec = current_time.hour * 3600 + current_time.minute * 60 + current_time.second
 
-    # Get next 3 unique trips for each direction
-    al_to_un_trips = get_upcoming_trips(stop_times_df, ALDERSHOT_STOP_ID, UNION_STOP_ID)
-    un_to_al_trips = get_upcoming_trips(stop_times_df, UNION_STOP_ID, ALDERSHOT_STOP_ID)
+    # Times of 24:00:00 and later belong to the previous service day, so yesterday's
+    # late-night trains are still upcoming until that service ends
+    today_services = get_active_service_ids(today)
+    if today_services is None:
+        print("⚠️ Neither calendar.txt nor calendar_dates.txt found; not filtering trips by service day.")
+    service_days = [
+        (today, now_sec, today_services),
+        (yesterday, now_sec + 86400, get_active_service_ids(yesterday)),
+    ]
 
-    # Print the results
-    print("\n🚆 Next 3 Departures: Aldershot → Union")
-    print(f"{'Trip ID':<15} {'Date':<12} {'Aldershot Departure':<12} {'Union Arrival':<12}")
-    for trip_id, date, dep, arr in al_to_un_trips:
-        print(f"{trip_id:<15} {date:<12} {dep.strftime('%H:%M:%S'):<12} {arr.strftime('%H:%M:%S'):<12}")
+    # Get next 3 unique trips for each direction, among trips running on those service days
+    upcoming = get_upcoming_trips(trip_pairs, service_days)
+    al_to_un_trips = upcoming.get((ALDERSHOT_STOP_ID, UNION_STOP_ID), [])
+    un_to_al_trips = upcoming.get((UNION_STOP_ID, ALDERSHOT_STOP_ID), [])
 
-    print("\n🚆 Next 3 Departures: Union → Aldershot")
-    print(f"{'Trip ID':<15} {'Date':<12} {'Union Departure':<12} {'Aldershot Arrival':<12}")
-    for trip_id, date, dep, arr in un_to_al_trips:
-        print(f"{trip_id:<15} {date:<12} {dep.strftime('%H:%M:%S'):<12} {arr.strftime('%H:%M:%S'):<12}")
+    # Print the results in a single write
+    sys.stdout.write("\n".join([
+        format_departures("Aldershot → Union", "Aldershot Departure", "Union Arrival", al_to_un_trips),
+        format_departures("Union → Aldershot", "Union Departure", "Aldershot Arrival", un_to_al_trips),
+    ]) + "\n")
 
 def main():
     fetch_gtfs()